@@ -2,16 +2,18 @@
 """Wyoming-Server für ElevenLabs STT."""
 import argparse
 import asyncio
+import hashlib
+import io
 import logging
-import os
-import tempfile
-import wave
-import requests
-from typing import Optional
+import shutil
+import struct
+import aiohttp
+from collections import OrderedDict
+from typing import Any, AsyncIterator, List, Optional, Tuple
 
 from wyoming.asr import Transcribe, Transcript
 from wyoming.audio import AudioChunk, AudioStop
-from wyoming.event import Event
+from wyoming.event import Event, write_event
 from wyoming.info import AsrModel, AsrProgram, Attribution, Describe, Info
 from wyoming.server import AsyncServer, AsyncEventHandler
 
@@ -29,114 +31,484 @@ except ImportError:
         _LOGGER.warning("Skipping Zeroconf registration (module not available)")
         pass
 
+# Use uvloop for a faster event loop when it is installed
+try:
+    import uvloop
+    _HAVE_UVLOOP = True
+except ImportError:
+    _HAVE_UVLOOP = False
+
+# Use orjson for faster parsing of API responses when it is installed
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 _LOGGER = logging.getLogger(__name__)
 
 # Version
 VERSION = "1.1.3"  # Keep version same for now
 
+
+# Supported languages
+SUPPORTED_LANGUAGES = ("de", "en", "es", "fr", "it", "ja", "pt", "nl")
+_SUPPORTED_LANGUAGE_SET = frozenset(SUPPORTED_LANGUAGES)
+DEFAULT_LANGUAGE = "de"
+
+# WAV header reserved at the start of every audio buffer
+_WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+_WAV_HEADER_SIZE = _WAV_HEADER.size
+
+# ffmpeg arguments, file name and content type for compressed uploads
+_AUDIO_CODECS = {
+    "flac": (["-c:a", "flac", "-f", "flac"], "speech.flac", "audio/flac"),
+    "opus": (
+        ["-c:a", "libopus", "-b:a", "24k", "-f", "ogg"],
+        "speech.ogg",
+        "audio/ogg",
+    ),
+}
+
+# Longer utterances (10 seconds of 16 kHz 16-bit mono) are rarely repeated
+# exactly, so they are neither hashed nor cached
+_MAX_CACHED_AUDIO_BYTES = 10 * 16000 * 2
+
+# Seconds ffmpeg may take before the WAV is uploaded instead
+_FFMPEG_TIMEOUT = 10
+
+# Data length announced for streamed uploads whose final size is unknown
+_STREAM_DATA_LEN = 0xFFFFFFFF - 36
+
+# Largest audio format accepted, so clients cannot raise the size cap at will
+_MAX_AUDIO_RATE = 48000
+_MAX_AUDIO_WIDTH = 4
+_MAX_AUDIO_CHANNELS = 2
+
+
+def _is_supported_format(rate: Any, width: Any, channels: Any) -> bool:
+    """Check that a client's audio format is within the accepted limits."""
+    return (
+        isinstance(rate, int)
+        and isinstance(width, int)
+        and isinstance(channels, int)
+        and 0 < rate <= _MAX_AUDIO_RATE
+        and 0 < width <= _MAX_AUDIO_WIDTH
+        and 0 < channels <= _MAX_AUDIO_CHANNELS
+    )
+
+
+def _pack_wav_header(
+    buffer: bytearray, data_len: int, rate: int, width: int, channels: int
+) -> None:
+    """Fill in the RIFF/WAVE header reserved at the start of a PCM buffer."""
+    _WAV_HEADER.pack_into(
+        buffer,
+        0,
+        b"RIFF",
+        36 + data_len,
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        channels,
+        rate,
+        rate * width * channels,  # byte rate
+        width * channels,  # block align
+        width * 8,  # bits per sample
+        b"data",
+        data_len,
+    )
+
+
+class _BufferPool:
+    """Audio buffers kept between utterances so their memory can be reused."""
+
+    def __init__(self, max_buffers: int, max_buffer_size: int) -> None:
+        self._buffers: List[bytearray] = []
+        self._max_buffers = max_buffers
+        self._max_buffer_size = max_buffer_size
+
+    def get(self) -> bytearray:
+        """Return a pooled buffer, or a new one if the pool is empty."""
+        if self._buffers:
+            return self._buffers.pop()
+
+        return bytearray(_WAV_HEADER_SIZE)
+
+    def put(self, buffer: bytearray) -> None:
+        """Give a buffer back once nothing references its contents anymore."""
+        if len(self._buffers) >= self._max_buffers:
+            return
+
+        # Do not keep the memory of unusually long utterances around
+        if len(buffer) > self._max_buffer_size:
+            return
+
+        # Shrinking or growing fails while a memoryview is still alive
+        try:
+            buffer.append(0)
+        except BufferError:
+            return
+        del buffer[-1]
+
+        self._buffers.append(buffer)
+
+
+# Only the event loop thread touches the pool, so it needs no lock.
+# Buffers larger than 60 seconds of 16 kHz 16-bit mono are not pooled.
+_AUDIO_BUFFER_POOL = _BufferPool(
+    max_buffers=4, max_buffer_size=_WAV_HEADER_SIZE + 60 * 16000 * 2
+)
+
+
+class _TranscriptCache:
+    """Recent transcripts keyed by a hash of the audio and its language."""
+
+    def __init__(self, max_size: int) -> None:
+        self._transcripts: "OrderedDict[Tuple[bytes, str], str]" = OrderedDict()
+        self._max_size = max_size
+
+    @staticmethod
+    def key(wav: memoryview, language: str) -> Tuple[bytes, str]:
+        """Build the cache key for an utterance."""
+        return hashlib.blake2b(wav, digest_size=16).digest(), language
+
+    def get(self, key: Tuple[bytes, str]) -> Optional[str]:
+        """Return the cached transcript, marking it as recently used."""
+        text = self._transcripts.get(key)
+        if text is not None:
+            self._transcripts.move_to_end(key)
+        return text
+
+    def put(self, key: Tuple[bytes, str], text: str) -> None:
+        """Store a transcript, evicting the least recently used one if full."""
+        self._transcripts[key] = text
+        self._transcripts.move_to_end(key)
+        if len(self._transcripts) > self._max_size:
+            self._transcripts.popitem(last=False)
+
+
 class ElevenLabsEventHandler(AsyncEventHandler):
     """Event handler for Wyoming protocol clients."""
 
     def __init__(
         self,
-        wyoming_info: Info,
-        api_key: str,
+        wyoming_info_bytes: bytes,
+        session: aiohttp.ClientSession,
         model_id: str,
+        stream_upload: bool,
+        max_audio_seconds: float,
+        audio_codec: str,
+        transcript_cache: Optional[_TranscriptCache],
         *args,
         **kwargs,
     ) -> None:
         super().__init__(*args, **kwargs)
-        self.wyoming_info_event = wyoming_info.event()
-        self.api_key = api_key
+        self.wyoming_info_bytes = wyoming_info_bytes
+        self.session = session
         self.model_id = model_id
-        self._language = "de"  # Default language
-        self._wav_dir = tempfile.TemporaryDirectory()
-        self._wav_path = os.path.join(self._wav_dir.name, "speech.wav")
-        self._wav_file: Optional[wave.Wave_write] = None
+        self.stream_upload = stream_upload
+        self.max_audio_seconds = max_audio_seconds
+        self.audio_codec = audio_codec
+        self.transcript_cache = transcript_cache
+        self._language = DEFAULT_LANGUAGE
+        self._audio_started = False
+        self._audio_size = 0
+        self._max_audio_bytes = 0
+        self._audio_buffer: Optional[bytearray] = None
+        self._audio_queue: Optional[asyncio.Queue] = None
+        self._upload_task: Optional[asyncio.Task] = None
+        self._audio_rate = 16000
+        self._audio_width = 2
+        self._audio_channels = 1
 
     async def handle_event(self, event: Event) -> bool:
         """Handle Wyoming protocol events."""
-        if AudioChunk.is_type(event.type):
-            chunk = AudioChunk.from_event(event)
-            if self._wav_file is None:
-                self._wav_file = wave.open(self._wav_path, "wb")
-                self._wav_file.setframerate(chunk.rate)
-                self._wav_file.setsampwidth(chunk.width)
-                self._wav_file.setnchannels(chunk.channels)
-            self._wav_file.writeframes(chunk.audio)
+        event_type = event.type
+
+        # Audio chunks are by far the most frequent event, so check them first
+        if AudioChunk.is_type(event_type):
+            # Read the event directly instead of building an AudioChunk per chunk
+            if not self._audio_started and not self._start_audio(event.data):
+                _LOGGER.warning(
+                    "Unsupported audio format %s, dropping request", event.data
+                )
+                await self.write_event(Transcript(text="").event())
+                return False
+            if event.payload:
+                self._audio_size += len(event.payload)
+                if self._audio_size > self._max_audio_bytes:
+                    _LOGGER.warning(
+                        "Audio exceeds %s seconds, dropping request",
+                        self.max_audio_seconds,
+                    )
+                    self._reset_audio()
+                    await self.write_event(Transcript(text="").event())
+                    return False
+                if self._audio_queue is not None:
+                    self._audio_queue.put_nowait(event.payload)
+                else:
+                    # Pooled buffers may be longer than the audio, so write in place
+                    end = _WAV_HEADER_SIZE + self._audio_size
+                    self._audio_buffer[end - len(event.payload) : end] = event.payload
             return True
 
-        if AudioStop.is_type(event.type):
+        if AudioStop.is_type(event_type):
             _LOGGER.debug(
                 "Audio stopped. Transcribing with language=%s",
                 self._language,
             )
             
-            if self._wav_file is None:
+            if not self._audio_started:
                 _LOGGER.warning("No audio received")
                 await self.write_event(Transcript(text="").event())
                 return False
-                
-            self._wav_file.close()
-            self._wav_file = None
-            
+
             try:
                 # Transcribe using ElevenLabs API
-                text = await self._transcribe_audio(self._wav_path, self._language)
+                if self._upload_task is not None:
+                    # Upload is already running, just end the audio stream
+                    self._audio_queue.put_nowait(None)
+                    text = await self._upload_task
+                else:
+                    text = await self._transcribe_buffered_audio()
                 _LOGGER.info(text)
                 await self.write_event(Transcript(text=text).event())
                 _LOGGER.debug("Completed request")
             except Exception as e:
-                _LOGGER.error(f"Error during transcription: {e}")
+                _LOGGER.error("Error during transcription: %s", e)
                 await self.write_event(Transcript(text="").event())
             
+            self._reset_audio()
+
             # Reset language to default
-            self._language = "de"
+            self._language = DEFAULT_LANGUAGE
             return False
 
-        if Transcribe.is_type(event.type):
+        if Transcribe.is_type(event_type):
             transcribe = Transcribe.from_event(event)
             if transcribe.language:
-                self._language = transcribe.language
-                _LOGGER.debug("Language set to %s", transcribe.language)
+                language = transcribe.language
+                if language not in _SUPPORTED_LANGUAGE_SET:
+                    # Accept regional variants such as "de-DE"
+                    language = language.split("-", 1)[0].lower()
+
+                if language in _SUPPORTED_LANGUAGE_SET:
+                    self._language = language
+                    _LOGGER.debug("Language set to %s", language)
+                else:
+                    _LOGGER.warning(
+                        "Unsupported language %s, using %s",
+                        transcribe.language,
+                        self._language,
+                    )
             return True
 
-        if Describe.is_type(event.type):
-            await self.write_event(self.wyoming_info_event)
+        if Describe.is_type(event_type):
+            self.writer.write(self.wyoming_info_bytes)
+            await self.writer.drain()
             _LOGGER.debug("Sent info")
             return True
 
         return True
 
-    async def _transcribe_audio(self, audio_path: str, language_code: str) -> str:
-        """Transcribe audio with ElevenLabs API."""
-        loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(
-            None, self._transcribe_audio_sync, audio_path, language_code
+    async def disconnect(self) -> None:
+        """Drop any unfinished upload when the client goes away."""
+        self._reset_audio()
+
+    def _start_audio(self, audio_format: dict) -> bool:
+        """Prepare for a new utterance using the format of its first chunk.
+
+        Returns False if the format is not supported.
+        """
+        rate = audio_format.get("rate")
+        width = audio_format.get("width")
+        channels = audio_format.get("channels")
+        if not _is_supported_format(rate, width, channels):
+            return False
+
+        self._audio_started = True
+        self._audio_size = 0
+        self._audio_rate = rate
+        self._audio_width = width
+        self._audio_channels = channels
+        self._max_audio_bytes = int(
+            self.max_audio_seconds
+            * self._audio_rate
+            * self._audio_width
+            * self._audio_channels
         )
 
-    def _transcribe_audio_sync(self, audio_path: str, language_code: str) -> str:
-        """Synchronous transcription with ElevenLabs API."""
-        url = "https://api.elevenlabs.io/v1/speech-to-text"
-        headers = {"xi-api-key": self.api_key}
-        
-        with open(audio_path, "rb") as f:
-            files = {"file": f}
-            data = {"model_id": self.model_id, "language_code": language_code}
-            
-            _LOGGER.debug("Sending audio to ElevenLabs API")
-            response = requests.post(url, headers=headers, files=files, data=data)
-            
-        if response.status_code != 200:
-            _LOGGER.error(
-                f"ElevenLabs API error: {response.status_code} - {response.text}"
+        if not self.stream_upload:
+            self._audio_buffer = _AUDIO_BUFFER_POOL.get()
+            return True
+
+        # Start uploading right away so the request overlaps with the speech.
+        # The final length is not known yet, so the header claims the maximum.
+        header = bytearray(_WAV_HEADER_SIZE)
+        _pack_wav_header(
+            header,
+            _STREAM_DATA_LEN,
+            self._audio_rate,
+            self._audio_width,
+            self._audio_channels,
+        )
+        self._audio_queue = asyncio.Queue()
+        self._audio_queue.put_nowait(header)
+        # The upload lasts as long as the speech, so only the socket timeouts apply
+        session_timeout = self.session.timeout
+        self._upload_task = asyncio.create_task(
+            self._transcribe_audio(
+                self._iter_audio_queue(self._audio_queue),
+                self._language,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=session_timeout.sock_connect,
+                    sock_read=session_timeout.sock_read,
+                ),
             )
-            return ""
-            
-        result = response.json()
+        )
+        # The upload may fail before AudioStop and is then never awaited
+        self._upload_task.add_done_callback(
+            lambda task: task.cancelled() or task.exception()
+        )
+        return True
+
+    def _reset_audio(self) -> None:
+        """Forget the current utterance and cancel its upload if still running."""
+        if self._upload_task is not None:
+            self._upload_task.cancel()
+
+        if self._audio_buffer is not None:
+            _AUDIO_BUFFER_POOL.put(self._audio_buffer)
+
+        self._audio_started = False
+        self._audio_buffer = None
+        self._audio_queue = None
+        self._upload_task = None
+
+    @staticmethod
+    async def _iter_audio_queue(queue: asyncio.Queue) -> AsyncIterator[bytes]:
+        """Yield queued audio until the end-of-stream marker arrives."""
+        while True:
+            audio = await queue.get()
+            if audio is None:
+                return
+            yield audio
+
+    async def _transcribe_audio(
+        self,
+        audio_file: Any,
+        language_code: str,
+        filename: str = "speech.wav",
+        content_type: str = "audio/wav",
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+    ) -> str:
+        """Transcribe audio with ElevenLabs API."""
+        url = "https://api.elevenlabs.io/v1/speech-to-text"
+
+        data = aiohttp.FormData()
+        data.add_field("file", audio_file, filename=filename, content_type=content_type)
+        data.add_field("model_id", self.model_id)
+        data.add_field("language_code", language_code)
+
+        _LOGGER.debug("Sending audio to ElevenLabs API")
+        async with self.session.post(
+            url, data=data, timeout=timeout or self.session.timeout
+        ) as response:
+            if response.status != 200:
+                _LOGGER.error(
+                    "ElevenLabs API error: %s - %s", response.status, await response.text()
+                )
+                return ""
+
+            result = _json.loads(await response.read())
+
         text = result.get("text", "")
         return text
 
+    async def _transcribe_buffered_audio(self) -> str:
+        """Transcribe the buffered utterance, using the cache when enabled."""
+        wav = self._build_wav()
+
+        cache_key = None
+        if (
+            self.transcript_cache is not None
+            and self._audio_size <= _MAX_CACHED_AUDIO_BYTES
+        ):
+            cache_key = self.transcript_cache.key(wav, self._language)
+            text = self.transcript_cache.get(cache_key)
+            if text is not None:
+                _LOGGER.debug("Using cached transcript")
+                return text
+
+        audio_file, filename, content_type = await self._encode_audio(wav)
+        text = await self._transcribe_audio(
+            audio_file, self._language, filename, content_type
+        )
+
+        # Empty text also means an API error, which should not be cached
+        if cache_key is not None and text:
+            self.transcript_cache.put(cache_key, text)
+
+        return text
+
+    async def _encode_audio(self, wav: memoryview) -> Tuple[Any, str, str]:
+        """Compress the WAV with ffmpeg if configured, falling back to WAV."""
+        if self.audio_codec not in _AUDIO_CODECS:
+            return wav, "speech.wav", "audio/wav"
+
+        codec_args, filename, content_type = _AUDIO_CODECS[self.audio_codec]
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                *codec_args,
+                "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            _LOGGER.warning("Could not run ffmpeg, sending WAV: %s", e)
+            return wav, "speech.wav", "audio/wav"
+
+        try:
+            encoded, stderr = await asyncio.wait_for(
+                proc.communicate(wav), timeout=_FFMPEG_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            _LOGGER.warning("ffmpeg timed out, sending WAV")
+            return wav, "speech.wav", "audio/wav"
+        finally:
+            # Do not leave ffmpeg running after a timeout or cancellation
+            if proc.returncode is None:
+                proc.kill()
+
+        if proc.returncode != 0 or not encoded:
+            _LOGGER.warning(
+                "ffmpeg failed, sending WAV: %s", stderr.decode(errors="replace").strip()
+            )
+            return wav, "speech.wav", "audio/wav"
+
+        _LOGGER.debug("Compressed %s bytes of WAV to %s bytes", len(wav), len(encoded))
+        return encoded, filename, content_type
+
+    def _build_wav(self) -> memoryview:
+        """Turn the audio buffer into a WAV file without copying the PCM data."""
+        _pack_wav_header(
+            self._audio_buffer,
+            self._audio_size,
+            self._audio_rate,
+            self._audio_width,
+            self._audio_channels,
+        )
+        return memoryview(self._audio_buffer)[: _WAV_HEADER_SIZE + self._audio_size]
+
 
 async def main() -> None:
     """Main function."""
@@ -146,6 +518,38 @@ async def main() -> None:
     parser.add_argument(
         "--model-id", default="scribe_v1", help="ElevenLabs model ID (default: scribe_v1)"
     )
+    parser.add_argument(
+        "--api-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds allowed for an ElevenLabs request (default: 30)",
+    )
+    parser.add_argument(
+        "--max-audio-seconds",
+        type=float,
+        default=60.0,
+        help="Longest utterance accepted from a client (default: 60)",
+    )
+    parser.add_argument(
+        "--audio-codec",
+        choices=["wav", *_AUDIO_CODECS],
+        default="wav",
+        help="Compress audio with ffmpeg before uploading (default: wav)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="Number of recent transcripts to cache, 0 disables (default: 64)",
+    )
+    parser.add_argument(
+        "--stream-upload",
+        action="store_true",
+        help=(
+            "Upload audio to ElevenLabs while it is still being received "
+            "(always WAV, without the transcript cache)"
+        ),
+    )
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     
     args = parser.parse_args()
@@ -156,10 +560,7 @@ async def main() -> None:
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
     
-    _LOGGER.info(f"ElevenLabs Wyoming Server starting. Version: {VERSION}")
-    
-    # Supported languages
-    supported_languages = ["de", "en", "es", "fr", "it", "ja", "pt", "nl"]
+    _LOGGER.info("ElevenLabs Wyoming Server starting. Version: %s", VERSION)
     
     # Create Wyoming info
     wyoming_info = Info(
@@ -182,7 +583,7 @@ async def main() -> None:
                             url="https://elevenlabs.io/speech-to-text",
                         ),
                         installed=True,
-                        languages=supported_languages,
+                        languages=list(SUPPORTED_LANGUAGES),
                         version=VERSION,
                     )
                 ],
@@ -208,21 +609,67 @@ async def main() -> None:
     # Create server
     server = AsyncServer.from_uri(args.uri)
     
+    # One HTTP session for all clients so the TLS connection is kept alive
+    session = aiohttp.ClientSession(
+        headers={"xi-api-key": args.api_key},
+        connector=aiohttp.TCPConnector(
+            limit=64, ttl_dns_cache=300, keepalive_timeout=60
+        ),
+        timeout=aiohttp.ClientTimeout(
+            total=args.api_timeout, sock_connect=10, sock_read=args.api_timeout
+        ),
+    )
+
     # Store CLI args for use in the handler factory
-    api_key = args.api_key
     model_id = args.model_id
+    stream_upload = args.stream_upload
+    max_audio_seconds = args.max_audio_seconds
+    audio_codec = args.audio_codec
+    transcript_cache = (
+        _TranscriptCache(args.cache_size) if args.cache_size > 0 else None
+    )
+    if audio_codec != "wav" and shutil.which("ffmpeg") is None:
+        _LOGGER.warning("ffmpeg not found, uploading WAV instead of %s", audio_codec)
+        audio_codec = "wav"
+    if stream_upload:
+        # Streamed audio is uploaded as it arrives, so it is never encoded or hashed
+        if audio_codec != "wav":
+            _LOGGER.warning(
+                "Audio codec %s is not used with streaming upload, sending WAV",
+                audio_codec,
+            )
+        if transcript_cache is not None:
+            _LOGGER.warning("Transcript cache is not used with streaming upload")
+
+    # Info is static, so serialize it once and send the same bytes to every client
+    info_io = io.BytesIO()
+    write_event(wyoming_info.event(), info_io)
+    wyoming_info_bytes = info_io.getvalue()
     
     try:
         await server.run(
             lambda reader, writer: ElevenLabsEventHandler(
-                wyoming_info, api_key, model_id, reader, writer
+                wyoming_info_bytes,
+                session,
+                model_id,
+                stream_upload,
+                max_audio_seconds,
+                audio_codec,
+                transcript_cache,
+                reader,
+                writer,
             )
         )
     except KeyboardInterrupt:
         _LOGGER.info("Server shutdown by keyboard interrupt")
+    finally:
+        await session.close()
 
 
 if __name__ == "__main__":
+    if _HAVE_UVLOOP:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -12,6 +12,10 @@ fi
 API_KEY=$(jq -r ".api_key // empty" $CONFIG_PATH)
 PORT=$(jq -r ".port // \"10200\"" $CONFIG_PATH)
 MODEL_ID=$(jq -r ".model_id // \"scribe_v1\"" $CONFIG_PATH)
+MAX_AUDIO_SECONDS=$(jq -r ".max_audio_seconds // \"60\"" $CONFIG_PATH)
+AUDIO_CODEC=$(jq -r ".audio_codec // \"wav\"" $CONFIG_PATH)
+CACHE_SIZE=$(jq -r ".cache_size // \"64\"" $CONFIG_PATH)
+STREAM_UPLOAD=$(jq -r ".stream_upload // \"false\"" $CONFIG_PATH)
 DEBUG=$(jq -r ".debug // \"false\"" $CONFIG_PATH)
 
 # Prüfen, ob API-Key vorhanden ist
@@ -26,6 +30,12 @@ if ! [[ "$PORT" =~ ^[0-9]+$ ]]; then
     PORT=10200
 fi
 
+# Streaming-Upload-Flag überprüfen
+STREAM_UPLOAD_FLAG=""
+if [ "$STREAM_UPLOAD" = "true" ]; then
+  STREAM_UPLOAD_FLAG="--stream-upload"
+fi
+
 # Debug-Flag überprüfen
 DEBUG_FLAG=""
 if [ "$DEBUG" = "true" ]; then
@@ -40,4 +50,8 @@ python3 /app/elevenlabs_wyoming.py \
   --api-key "$API_KEY" \
   --uri "$WYOMING_URI" \
   --model-id "$MODEL_ID" \
+  --max-audio-seconds "$MAX_AUDIO_SECONDS" \
+  --audio-codec "$AUDIO_CODEC" \
+  --cache-size "$CACHE_SIZE" \
+  $STREAM_UPLOAD_FLAG \
   $DEBUG_FLAG
\ No newline at end of file